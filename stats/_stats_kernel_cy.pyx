@@ -0,0 +1,47 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Cython build of the stats_kernel summary loop, compiled with
+"python stats_kernel.py --build". Same semantics as _summarize_loop in
+stats_kernel.py, for int32 read lengths sorted in ascending order.
+"""
+
+import numpy as np
+from libc.stdint cimport int32_t, int64_t
+
+
+def summarize_loop(const int32_t[::1] lengths_asc, double target, const int32_t[::1] thresholds):
+    cdef Py_ssize_t n_thresholds = thresholds.shape[0]
+    cdef Py_ssize_t i, k
+    cdef int64_t cumulative = 0
+    cdef int32_t x, n50 = 0, shortest = 0
+    cdef bint found = False
+
+    counts_arr = np.zeros(n_thresholds, dtype=np.int64)
+    tail_arr = np.zeros(n_thresholds, dtype=np.int64)
+    cdef int64_t[::1] counts = counts_arr
+    cdef int64_t[::1] tail_bases = tail_arr
+
+    if n_thresholds:
+        shortest = thresholds[0]
+        for k in range(1, n_thresholds):
+            if thresholds[k] < shortest:
+                shortest = thresholds[k]
+
+    # Walk from the longest read down
+    with nogil:
+        for i in range(lengths_asc.shape[0] - 1, -1, -1):
+            x = lengths_asc[i]
+            cumulative += x
+            if not found and cumulative >= target:
+                n50 = x
+                found = True
+            # Lengths are sorted, so nothing below the shortest threshold contributes
+            if x < shortest:
+                if found:
+                    break
+                continue
+            for k in range(n_thresholds):
+                if x >= thresholds[k]:
+                    counts[k] += 1
+                    tail_bases[k] += x
+    return n50, counts_arr, tail_arr
@@ -33,8 +33,23 @@ Usage Examples:
     python calculate_summary_stats_rna.py --dir "/project/out" --nameby filename
 """
 
-import os, sys, time, gzip, glob, csv
+import os, sys, time, glob, csv
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyarrow as pa
+from stats_kernel import (summarize, length_histogram, merge_histograms, summarize_histogram,
+                          count_at_or_above)
+from summary_io import (LENGTH_COLUMN, QSCORE_COLUMN, READ_ERRORS, available_cpus, find_summary_files,
+                        init_worker, iter_blocks)
+
+# Only the length and q-score columns are converted; rows where either does not
+# parse are skipped
+COLUMN_TYPES = {LENGTH_COLUMN: pa.int32(), QSCORE_COLUMN: pa.float32()}
+
+QSCORE_THRESHOLDS = np.array([5, 10, 15, 20, 25], dtype=np.float32)
+# The RNA report only needs N50 from the length kernel
+NO_THRESHOLDS = np.array([], dtype=np.int32)
 
 
 def get_label(filepath, dirpath, nameby):
@@ -57,56 +72,17 @@ def get_label(filepath, dirpath, nameby):
     return os.path.basename(filepath)
 
 
-def _open_file(inFile):
-    if inFile.endswith('.gz'):
-        return gzip.open(inFile, 'rt')
-    return open(inFile, 'r')
-
-
 def _parse_file(inFile):
     """
-    Generator that yields (length, qscore) for each read in a summary file.
-    Reads line-by-line to avoid loading the full file into memory.
+    Generator that yields (lengths, qscores) NumPy arrays for each block of a
+    summary file. The file is streamed through arrow's CSV reader, so only one
+    block is held in memory at a time, and only these two columns are
+    converted; every other column (read_id, run_id, ...) is skipped.
+    A read error (one of READ_ERRORS) can be raised after some blocks have been
+    yielded; callers must then discard everything counted for the file.
     """
-    try:
-        f = _open_file(inFile)
-    except Exception as e:
-        sys.stderr.write("Error opening file %s: %s\n" % (inFile, str(e)))
-        return
-
-    try:
-        header = f.readline().strip().split()
-    except Exception as e:
-        sys.stderr.write("Error reading header of %s: %s\n" % (inFile, str(e)))
-        f.close()
-        return
-
-    try:
-        length_index = header.index("sequence_length_template")
-    except ValueError:
-        sys.stderr.write("Error: 'sequence_length_template' not found in header of %s\n" % inFile)
-        f.close()
-        return
-
-    try:
-        qscore_index = header.index("mean_qscore_template")
-    except ValueError:
-        sys.stderr.write("Error: 'mean_qscore_template' not found in header of %s\n" % inFile)
-        f.close()
-        return
-
-    for line in f:
-        parts = line.strip().split()
-        if len(parts) <= max(length_index, qscore_index):
-            continue
-        try:
-            length = int(parts[length_index])
-            qscore = float(parts[qscore_index])
-        except ValueError:
-            continue
-        yield length, qscore
-
-    f.close()
+    for block in iter_blocks(inFile, COLUMN_TYPES):
+        yield block[LENGTH_COLUMN].to_numpy(), block[QSCORE_COLUMN].to_numpy()
 
 
 def process_rna_file(inFile):
@@ -116,42 +92,41 @@ def process_rna_file(inFile):
     """
     total_reads = 0
     total_bases = 0
-    count_q5 = count_q10 = count_q15 = count_q20 = count_q25 = 0
-    read_lengths = []
-
-    for length, qscore in _parse_file(inFile):
-        total_reads += 1
-        total_bases += length
-        read_lengths.append(length)
-        if qscore >= 5:  count_q5  += 1
-        if qscore >= 10: count_q10 += 1
-        if qscore >= 15: count_q15 += 1
-        if qscore >= 20: count_q20 += 1
-        if qscore >= 25: count_q25 += 1
+    qscore_counts = np.zeros(len(QSCORE_THRESHOLDS), dtype=np.int64)
+    length_arrays = []
+
+    try:
+        for lengths, qscores in _parse_file(inFile):
+            total_reads += len(lengths)
+            total_bases += int(lengths.sum(dtype=np.int64))
+            qscore_counts += count_at_or_above(qscores, QSCORE_THRESHOLDS)
+            length_arrays.append(lengths)
+    except READ_ERRORS as e:
+        sys.stderr.write("Error reading %s: %s\n" % (inFile, str(e)))
+        return None
 
     if total_reads == 0:
         return None
 
-    read_lengths.sort(reverse=True)
-    cumulative_bases = 0
-    N50 = 0
+    # Gbp and the q-score counts in millions, rounded together
+    total_Gbp, q5_M, q10_M, q15_M, q20_M, q25_M = \
+        np.round(np.append(total_bases / 1E9, qscore_counts / 1E6), 2).tolist()
+
+    read_lengths = np.concatenate(length_arrays)
+    read_lengths.sort()
     target = total_bases / 2.0
-    for length in read_lengths:
-        cumulative_bases += length
-        if cumulative_bases >= target:
-            N50 = length
-            break
+    N50, _, _ = summarize(read_lengths, target, NO_THRESHOLDS)
 
     return {
         'Sample': inFile,  # will be transformed below
-        'total_Gbp': round(total_bases / 1E9, 2),
+        'total_Gbp': total_Gbp,
         'N50': N50,
         'total_reads_M': total_reads / 1E6,
-        'q5_reads_M':  round(count_q5  / 1E6, 2),
-        'q10_reads_M': round(count_q10 / 1E6, 2),
-        'q15_reads_M': round(count_q15 / 1E6, 2),
-        'q20_reads_M': round(count_q20 / 1E6, 2),
-        'q25_reads_M': round(count_q25 / 1E6, 2),
+        'q5_reads_M':  q5_M,
+        'q10_reads_M': q10_M,
+        'q15_reads_M': q15_M,
+        'q20_reads_M': q20_M,
+        'q25_reads_M': q25_M,
     }
 
 
@@ -162,43 +137,54 @@ def process_aggregated_rna_files(file_list):
     """
     total_reads = 0
     total_bases = 0
-    count_q5 = count_q10 = count_q15 = count_q20 = count_q25 = 0
-    read_lengths = []
+    qscore_counts = np.zeros(len(QSCORE_THRESHOLDS), dtype=np.int64)
+    hist = None
 
+    # Stream each file block by block, folding lengths into a histogram so no
+    # block is kept once it has been counted. Counts are kept per file and only
+    # added to the totals once the whole file has been read, so a file that
+    # fails partway contributes nothing.
     for inFile in file_list:
-        for length, qscore in _parse_file(inFile):
-            total_reads += 1
-            total_bases += length
-            read_lengths.append(length)
-            if qscore >= 5:  count_q5  += 1
-            if qscore >= 10: count_q10 += 1
-            if qscore >= 15: count_q15 += 1
-            if qscore >= 20: count_q20 += 1
-            if qscore >= 25: count_q25 += 1
+        file_reads = 0
+        file_bases = 0
+        file_qscore_counts = np.zeros(len(QSCORE_THRESHOLDS), dtype=np.int64)
+        file_hist = None
+        try:
+            for lengths, qscores in _parse_file(inFile):
+                file_reads += len(lengths)
+                file_bases += int(lengths.sum(dtype=np.int64))
+                file_qscore_counts += count_at_or_above(qscores, QSCORE_THRESHOLDS)
+                file_hist = length_histogram(lengths, file_hist)
+        except READ_ERRORS as e:
+            sys.stderr.write("Error reading %s: %s\n" % (inFile, str(e)))
+            continue
+        if file_hist is None:
+            continue
+        total_reads += file_reads
+        total_bases += file_bases
+        qscore_counts += file_qscore_counts
+        hist = merge_histograms(hist, file_hist)
 
     if total_reads == 0:
         return None
 
-    read_lengths.sort(reverse=True)
-    cumulative_bases = 0
-    N50 = 0
+    # Gbp and the q-score counts in millions, rounded together
+    total_Gbp, q5_M, q10_M, q15_M, q20_M, q25_M = \
+        np.round(np.append(total_bases / 1E9, qscore_counts / 1E6), 2).tolist()
+
     target = total_bases / 2.0
-    for length in read_lengths:
-        cumulative_bases += length
-        if cumulative_bases >= target:
-            N50 = length
-            break
+    N50, _, _ = summarize_histogram(hist, target, NO_THRESHOLDS)
 
     return {
         'Sample': ",".join(file_list),
-        'total_Gbp': round(total_bases / 1E9, 2),
+        'total_Gbp': total_Gbp,
         'N50': N50,
         'total_reads_M': total_reads / 1E6,
-        'q5_reads_M':  round(count_q5  / 1E6, 2),
-        'q10_reads_M': round(count_q10 / 1E6, 2),
-        'q15_reads_M': round(count_q15 / 1E6, 2),
-        'q20_reads_M': round(count_q20 / 1E6, 2),
-        'q25_reads_M': round(count_q25 / 1E6, 2),
+        'q5_reads_M':  q5_M,
+        'q10_reads_M': q10_M,
+        'q15_reads_M': q15_M,
+        'q20_reads_M': q20_M,
+        'q25_reads_M': q25_M,
     }
 
 
@@ -231,18 +217,20 @@ def main(myCommandLine=None):
         if not dirs:
             sys.stderr.write("No directories match the pattern: %s\n" % args.directory)
             sys.exit(1)
-        results = []
+        # Collect (file, matched dir) pairs first so files can be processed in parallel
+        jobs = []
         for d in dirs:
             if not os.path.isdir(d):
                 continue
-            seq_summary_files = glob.glob(os.path.join(d, "**", "sequencing_summary*"), recursive=True)
-            summary_files     = glob.glob(os.path.join(d, "**", "*_summary.txt.gz"), recursive=True)
-            files = seq_summary_files + summary_files
+            files = find_summary_files(d)
             if not files:
                 sys.stderr.write("Warning: No sequencing_summary files found in directory %s\n" % d)
                 continue
-            for f in files:
-                res = process_rna_file(f)
+            jobs.extend((f, d) for f in files)
+        results = []
+        with ProcessPoolExecutor(max_workers=available_cpus(),
+                                 initializer=init_worker) as executor:
+            for (f, d), res in zip(jobs, executor.map(process_rna_file, [f for f, _ in jobs], chunksize=1)):
                 if res is not None:
                     res["Sample"] = get_label(f, d, args.nameby)
                     if args.append_str:
@@ -38,10 +38,20 @@ from __future__ import print_function
 import os
 import sys
 import time
-import gzip
 import glob
 import csv
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from optparse import OptionParser
+from stats_kernel import summarize, length_histogram, summarize_histogram
+from summary_io import available_cpus, find_summary_files, init_worker, read_summary
+
+# Read lengths are parsed as int32 (reads are far below 2^31 bp); sums and cumsums use int64
+LENGTH_THRESHOLDS = np.array([100000, 200000, 300000, 400000, 500000, 1000000], dtype=np.int32)
+
+# Header columns holding the pod5 filename the flowcell id is taken from, in order of preference
+FILENAME_COLUMNS = ("filename", "filename_pod5", "input_filename")
 
 def get_label(filepath, dirpath, nameby):
     """
@@ -65,101 +75,31 @@ def get_label(filepath, dirpath, nameby):
 def process_single_file(inFile, actual_genome_size):
     """
     Process a single sequencing_summary file and compute statistics.
-    Extracts the first '_'‐delimited field from the pod5 filename column
-    (either 'filename', 'filename_pod5', or 'input_filename') of the first data line
-    and calls that 'flowcell_id'. Returns a dictionary of stats or None.
+    Returns a dictionary of stats or None.
     """
-    read_lengths = []
-    bases = 0
-    flowcell_id = None
-
-    # Open (possibly gzipped)
-    try:
-        if inFile.endswith('.gz'):
-            f = gzip.open(inFile, 'rt')
-        else:
-            f = open(inFile, 'r')
-    except Exception as e:
-        sys.stderr.write("Error opening file %s: %s\n" % (inFile, str(e)))
+    parsed = read_summary(inFile, FILENAME_COLUMNS)
+    if parsed is None:
         return None
+    read_lengths, flowcell_ids = parsed
+    bases = int(read_lengths.sum(dtype=np.int64))
 
-    # Read header to find the index of "sequence_length_template" and filename column
-    header = f.readline().strip().split()
-    try:
-        length_index = header.index("sequence_length_template")
-    except ValueError:
-        sys.stderr.write("Error: 'sequence_length_template' not found in header of %s\n" % inFile)
-        f.close()
-        return None
-
-    # Look for filename column - try filename variants
-    filename_index = None
-    for possible_name in ["filename", "filename_pod5", "input_filename"]:
-        try:
-            filename_index = header.index(possible_name)
-            break
-        except ValueError:
-            continue
-
-    if filename_index is None:
-        sys.stderr.write("Warning: Neither 'filename', 'filename_pod5', nor 'input_filename' found in header of %s\n" % inFile)
-
-    # Iterate through every data line
-    for line in f:
-        # Skip repeated header lines, if any
-        if ('filename' in line or 'input_filename' in line) and 'read_id' in line:
-            continue
-
-        parts = line.strip().split()
-        if len(parts) <= length_index:
-            continue
-
-        # On the very first valid data row, grab the pod‐filename (parts[filename_index]),
-        # split on '_', and take the first field as flowcell_id.
-        if flowcell_id is None and filename_index is not None and len(parts) > filename_index:
-            pod_filename = parts[filename_index]        # e.g. "PBE83079_skip_15726cb4_58deb308_0.pod5"
-            flowcell_id = pod_filename.split("_")[0]    # e.g. "PBE83079"
-
-        # Collect read length
-        try:
-            length = int(parts[length_index])
-        except ValueError:
-            continue
-
-        read_lengths.append(length)
-        bases += length
-
-    f.close()
-
-    if not read_lengths:
-        return None
-
-    # Sort descending
-    read_lengths.sort(reverse=True)
+    # Sort once, ascending; the kernel reuses it
+    lengths_asc = np.sort(read_lengths)
     total_bases = bases
-    total_gigabases = round(total_bases / 1e9, 2)
     target = total_bases / 2.0
 
-    cumulative = 0
-    n50_val = 0
-    for x in read_lengths:
-        cumulative += x
-        if cumulative >= target:
-            n50_val = x
-            break
-
-    coverage = round(total_bases / actual_genome_size, 2)
-    lt100 = round(sum(i for i in read_lengths if i >= 100000) / actual_genome_size, 2)
-    lt200 = round(sum(i for i in read_lengths if i >= 200000) / actual_genome_size, 2)
-    lt300 = round(sum(i for i in read_lengths if i >= 300000) / actual_genome_size, 2)
-    lt400 = round(sum(i for i in read_lengths if i >= 400000) / actual_genome_size, 2)
-    lt500 = round(sum(i for i in read_lengths if i >= 500000) / actual_genome_size, 2)
-    lt1000 = round(sum(i for i in read_lengths if i >= 1000000) / actual_genome_size, 2)
-    num1000 = len([i for i in read_lengths if i >= 1000000])
+    # N50 plus reads/bases at or above each threshold, in one pass over the longest reads
+    n50_val, num_above, tail_bases = summarize(lengths_asc, target, LENGTH_THRESHOLDS)
+
+    # Gb, coverage and the per-threshold coverages, rounded together
+    scaled = np.concatenate(([total_bases / 1e9, total_bases / actual_genome_size],
+                             tail_bases / actual_genome_size))
+    total_gigabases, coverage, lt100, lt200, lt300, lt400, lt500, lt1000 = np.round(scaled, 2).tolist()
+    num1000 = int(num_above[-1])
 
     return {
         'File'        : inFile,
-        'flowcell_id' : flowcell_id or "",
+        'flowcell_id' : ";".join(sorted(flowcell_ids)),
         'read_N50'    : n50_val,
         'Gb'          : total_gigabases,
         'coverage'    : coverage,
@@ -180,87 +120,33 @@ def process_aggregated_files(inFile_list, actual_genome_size):
     in each file, collects them in a set, and joins with semicolons.
     Returns a stats dictionary or None.
     """
-    read_lengths = []
+    hist = None
     bases = 0
     flowcell_ids = set()
 
+    # Fold each file into a read-length histogram so only one file's lengths are held at a time
     for inFile in inFile_list:
-        try:
-            if inFile.endswith('.gz'):
-                f = gzip.open(inFile, 'rt')
-            else:
-                f = open(inFile, 'r')
-        except Exception as e:
-            sys.stderr.write("Error opening file %s: %s\n" % (inFile, str(e)))
-            continue
-
-        header = f.readline().strip().split()
-        try:
-            length_index = header.index("sequence_length_template")
-        except ValueError:
-            sys.stderr.write("Error: 'sequence_length_template' not found in header of %s\n" % inFile)
-            f.close()
+        parsed = read_summary(inFile, FILENAME_COLUMNS)
+        if parsed is None:
             continue
+        lengths, file_flowcell_ids = parsed
+        hist = length_histogram(lengths, hist)
+        bases += int(lengths.sum(dtype=np.int64))
+        flowcell_ids |= file_flowcell_ids
 
-        # Look for filename column - try filename variants
-        filename_index = None
-        for possible_name in ["filename", "filename_pod5", "input_filename"]:
-            try:
-                filename_index = header.index(possible_name)
-                break
-            except ValueError:
-                continue
-
-        first_data_line = True
-        for line in f:
-            if ('filename' in line or 'input_filename' in line) and 'read_id' in line:
-                continue
-
-            parts = line.strip().split()
-            if len(parts) <= length_index:
-                continue
-
-            # On the very first valid data row of this file, capture the pod filename's prefix
-            if first_data_line and filename_index is not None and len(parts) > filename_index:
-                pod_filename = parts[filename_index]
-                prefix = pod_filename.split("_")[0]
-                flowcell_ids.add(prefix)
-                first_data_line = False
-
-            try:
-                length = int(parts[length_index])
-            except ValueError:
-                continue
-
-            read_lengths.append(length)
-            bases += length
-
-        f.close()
-
-    if not read_lengths:
+    if hist is None:
         return None
 
-    read_lengths.sort(reverse=True)
     total_bases = bases
-    total_gigabases = round(total_bases / 1e9, 2)
     target = total_bases / 2.0
 
-    cumulative = 0
-    n50_val = 0
-    for x in read_lengths:
-        cumulative += x
-        if cumulative >= target:
-            n50_val = x
-            break
-
-    coverage = round(total_bases / actual_genome_size, 2)
-    lt100 = round(sum(i for i in read_lengths if i >= 100000) / actual_genome_size, 2)
-    lt200 = round(sum(i for i in read_lengths if i >= 200000) / actual_genome_size, 2)
-    lt300 = round(sum(i for i in read_lengths if i >= 300000) / actual_genome_size, 2)
-    lt400 = round(sum(i for i in read_lengths if i >= 400000) / actual_genome_size, 2)
-    lt500 = round(sum(i for i in read_lengths if i >= 500000) / actual_genome_size, 2)
-    lt1000 = round(sum(i for i in read_lengths if i >= 1000000) / actual_genome_size, 2)
-    num1000 = len([i for i in read_lengths if i >= 1000000])
+    n50_val, num_above, tail_bases = summarize_histogram(hist, target, LENGTH_THRESHOLDS)
+
+    # Gb, coverage and the per-threshold coverages, rounded together
+    scaled = np.concatenate(([total_bases / 1e9, total_bases / actual_genome_size],
+                             tail_bases / actual_genome_size))
+    total_gigabases, coverage, lt100, lt200, lt300, lt400, lt500, lt1000 = np.round(scaled, 2).tolist()
+    num1000 = int(num_above[-1])
 
     # Join all unique prefixes (should usually all be the same) with semicolons
     flowcell_str = ";".join(sorted(flowcell_ids)) if flowcell_ids else ""
@@ -331,20 +217,25 @@ def main(myCommandLine=None):
             sys.stderr.write("No directories match the pattern: %s\n" % options.directory)
             sys.exit(1)
 
+        # Collect (file, matched dir) pairs first so files can be processed in parallel
+        jobs = []
         for d in dirs:
             if not os.path.isdir(d):
                 continue
 
-            seq_summary_files = glob.glob(os.path.join(d, "**", "sequencing_summary*"), recursive=True)
-            summary_files     = glob.glob(os.path.join(d, "**", "*_summary.txt.gz"), recursive=True)
-            files = seq_summary_files + summary_files
+            files = find_summary_files(d)
 
             if not files:
                 sys.stderr.write("Warning: No sequencing summary files found in directory %s\n" % d)
                 continue
 
-            for f in files:
-                stats = process_single_file(f, actual_genome_size)
+            jobs.extend((f, d) for f in files)
+
+        # Results come back in submission order, so rows are written as before
+        process = functools.partial(process_single_file, actual_genome_size=actual_genome_size)
+        with ProcessPoolExecutor(max_workers=available_cpus(),
+                                 initializer=init_worker) as executor:
+            for (f, d), stats in zip(jobs, executor.map(process, [f for f, _ in jobs], chunksize=1)):
                 if stats is None:
                     continue
 
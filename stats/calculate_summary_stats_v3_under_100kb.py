@@ -39,10 +39,20 @@ from __future__ import print_function
 import os
 import sys
 import time
-import gzip
 import glob
 import csv
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from optparse import OptionParser
+from stats_kernel import summarize, length_histogram, summarize_histogram
+from summary_io import available_cpus, find_summary_files, init_worker, read_summary
+
+# Read lengths are parsed as int32 (reads are far below 2^31 bp); sums and cumsums use int64
+LENGTH_THRESHOLDS = np.array([20000, 40000, 60000, 80000, 100000], dtype=np.int32)
+
+# Header columns holding the pod5 filename the flowcell id is taken from, in order of preference
+FILENAME_COLUMNS = ("filename_pod5", "filename")
 
 def get_label(filepath, dirpath, nameby):
     """
@@ -63,86 +73,29 @@ def get_label(filepath, dirpath, nameby):
         return ",".join(os.path.basename(p) for p in filepath.split(","))
     return os.path.basename(filepath)
 
-def extract_flowcell_id(header, parts):
-    try:
-        idx = header.index("filename_pod5")
-    except ValueError:
-        try:
-            idx = header.index("filename")
-        except ValueError:
-            return ""
-
-    if len(parts) > idx:
-        return parts[idx].split("_")[0]
-    return ""
-
 def process_single_file(inFile, actual_genome_size):
-    read_lengths = []
-    bases = 0
-    flowcell_id = None
-
-    try:
-        f = gzip.open(inFile, 'rt') if inFile.endswith('.gz') else open(inFile, 'r')
-    except Exception as e:
-        sys.stderr.write("Error opening file %s: %s\n" % (inFile, str(e)))
-        return None
-
-    header = f.readline().strip().split()
-    try:
-        length_index = header.index("sequence_length_template")
-    except ValueError:
-        sys.stderr.write("Error: 'sequence_length_template' not found in header of %s\n" % inFile)
-        f.close()
-        return None
-
-    for line in f:
-        if 'filename' in line and 'read_id' in line:
-            continue
-
-        parts = line.strip().split()
-        if len(parts) <= length_index:
-            continue
-
-        if flowcell_id is None:
-            flowcell_id = extract_flowcell_id(header, parts)
-
-        try:
-            length = int(parts[length_index])
-        except ValueError:
-            continue
-
-        read_lengths.append(length)
-        bases += length
-
-    f.close()
-
-    if not read_lengths:
+    parsed = read_summary(inFile, FILENAME_COLUMNS)
+    if parsed is None:
         return None
+    read_lengths, flowcell_ids = parsed
+    bases = int(read_lengths.sum(dtype=np.int64))
 
-    read_lengths.sort(reverse=True)
+    lengths_asc = np.sort(read_lengths)
     total_bases = bases
-    total_gigabases = round(total_bases / 1e9, 2)
     target = total_bases / 2.0
 
-    cumulative = 0
-    n50_val = 0
-    for x in read_lengths:
-        cumulative += x
-        if cumulative >= target:
-            n50_val = x
-            break
-
-    coverage = round(total_bases / actual_genome_size, 2)
-    lt20 = round(sum(i for i in read_lengths if i >= 20000) / actual_genome_size, 2)
-    lt40 = round(sum(i for i in read_lengths if i >= 40000) / actual_genome_size, 2)
-    lt60 = round(sum(i for i in read_lengths if i >= 60000) / actual_genome_size, 2)
-    lt80 = round(sum(i for i in read_lengths if i >= 80000) / actual_genome_size, 2)
-    lt100 = round(sum(i for i in read_lengths if i >= 100000) / actual_genome_size, 2)
-    num1000 = len([i for i in read_lengths if i >= 1000000])
+    # N50 plus reads/bases at or above each threshold, in one pass over the longest reads
+    n50_val, num_above, tail_bases = summarize(lengths_asc, target, LENGTH_THRESHOLDS)
+
+    # Gb, coverage and the per-threshold coverages, rounded together
+    scaled = np.concatenate(([total_bases / 1e9, total_bases / actual_genome_size],
+                             tail_bases / actual_genome_size))
+    total_gigabases, coverage, lt20, lt40, lt60, lt80, lt100 = np.round(scaled, 2).tolist()
+    num1000 = int(len(lengths_asc) - np.searchsorted(lengths_asc, 1000000))
 
     return {
         'File': inFile,
-        'flowcell_id': flowcell_id or "",
+        'flowcell_id': ",".join(sorted(flowcell_ids)),
         'read_N50': n50_val,
         'Gb': total_gigabases,
         'coverage': coverage,
@@ -155,72 +108,36 @@ def process_single_file(inFile, actual_genome_size):
     }
 
 def process_aggregated_files(files, actual_genome_size):
-    read_lengths = []
+    hist = None
     bases = 0
     flowcell_ids = set()
     file_names = []
 
     for inFile in files:
-        try:
-            f = gzip.open(inFile, 'rt') if inFile.endswith('.gz') else open(inFile, 'r')
-        except Exception as e:
-            sys.stderr.write("Error opening file %s: %s\n" % (inFile, str(e)))
+        parsed = read_summary(inFile, FILENAME_COLUMNS, all_rows=True)
+        if parsed is None:
             continue
-
+        lengths, file_flowcell_ids = parsed
         file_names.append(inFile)
-        header = f.readline().strip().split()
-        try:
-            length_index = header.index("sequence_length_template")
-        except ValueError:
-            sys.stderr.write("Error: 'sequence_length_template' not found in header of %s\n" % inFile)
-            f.close()
-            continue
-
-        for line in f:
-            if 'filename' in line and 'read_id' in line:
-                continue
+        hist = length_histogram(lengths, hist)
+        bases += int(lengths.sum(dtype=np.int64))
+        flowcell_ids |= file_flowcell_ids
 
-            parts = line.strip().split()
-            if len(parts) <= length_index:
-                continue
-
-            flowcell_id = extract_flowcell_id(header, parts)
-            if flowcell_id:
-                flowcell_ids.add(flowcell_id)
-
-            try:
-                length = int(parts[length_index])
-            except ValueError:
-                continue
-
-            read_lengths.append(length)
-            bases += length
-
-        f.close()
-
-    if not read_lengths:
+    if hist is None:
         return None
 
-    read_lengths.sort(reverse=True)
     total_bases = bases
-    total_gigabases = round(total_bases / 1e9, 2)
     target = total_bases / 2.0
 
-    cumulative = 0
-    n50_val = 0
-    for x in read_lengths:
-        cumulative += x
-        if cumulative >= target:
-            n50_val = x
-            break
-
-    coverage = round(total_bases / actual_genome_size, 2)
-    lt20 = round(sum(i for i in read_lengths if i >= 20000) / actual_genome_size, 2)
-    lt40 = round(sum(i for i in read_lengths if i >= 40000) / actual_genome_size, 2)
-    lt60 = round(sum(i for i in read_lengths if i >= 60000) / actual_genome_size, 2)
-    lt80 = round(sum(i for i in read_lengths if i >= 80000) / actual_genome_size, 2)
-    lt100 = round(sum(i for i in read_lengths if i >= 100000) / actual_genome_size, 2)
-    num1000 = len([i for i in read_lengths if i >= 100000])
+    # The last threshold counts the whales (reads of 1 Mb or more)
+    thresholds = np.append(LENGTH_THRESHOLDS, np.int32(1000000))
+    n50_val, num_above, tail_bases = summarize_histogram(hist, target, thresholds)
+
+    # Gb, coverage and the per-threshold coverages, rounded together
+    scaled = np.concatenate(([total_bases / 1e9, total_bases / actual_genome_size],
+                             tail_bases[:-1] / actual_genome_size))
+    total_gigabases, coverage, lt20, lt40, lt60, lt80, lt100 = np.round(scaled, 2).tolist()
+    num1000 = int(num_above[-1])
 
     return {
         'File': ",".join(file_names),
@@ -286,20 +203,25 @@ def main(myCommandLine=None):
             sys.stderr.write("No directories match the pattern: %s\n" % options.directory)
             sys.exit(1)
 
+        # Collect (file, matched dir) pairs first so files can be processed in parallel
+        jobs = []
         for d in dirs:
             if not os.path.isdir(d):
                 continue
 
-            seq_summary_files = glob.glob(os.path.join(d, "**", "sequencing_summary*"), recursive=True)
-            summary_files     = glob.glob(os.path.join(d, "**", "*_summary.txt.gz"), recursive=True)
-            files = seq_summary_files + summary_files
+            files = find_summary_files(d)
 
             if not files:
                 sys.stderr.write("Warning: No sequencing summary files found in directory %s\n" % d)
                 continue
 
-            for f in files:
-                stats = process_single_file(f, actual_genome_size)
+            jobs.extend((f, d) for f in files)
+
+        # Results come back in submission order, so rows are written as before
+        process = functools.partial(process_single_file, actual_genome_size=actual_genome_size)
+        with ProcessPoolExecutor(max_workers=available_cpus(),
+                                 initializer=init_worker) as executor:
+            for (f, d), stats in zip(jobs, executor.map(process, [f for f, _ in jobs], chunksize=1)):
                 if stats is None:
                     continue
 
@@ -0,0 +1,328 @@
+"""
+stats_kernel.py
+
+Read-length summary kernel shared by the calculate_summary_stats_* scripts.
+
+Given the read lengths of a sample sorted in ascending order, summarize() returns
+the N50 together with, for every length threshold, the number of reads and the
+number of bases in reads at or above that threshold.
+
+The kernel is a single pass over the sorted lengths. It is taken from, in order
+of preference: the Cython extension built from _stats_kernel_cy.pyx, numba
+(JIT-compiled once and cached on disk), or an equivalent NumPy implementation.
+All return the same values. The extension is used only once it has been built,
+with "python stats_kernel.py --build" (needs Cython and a C compiler); until
+then the scripts run on numba or NumPy. The Cython kernel takes int32 lengths
+and thresholds; other dtypes go through numba or NumPy.
+
+For aggregated inputs, length_histogram() folds blocks of read lengths into a
+one-bin-per-length histogram and summarize_histogram() computes the same values
+from it, so the full set of read lengths never has to be held or sorted. Bins
+stop at HISTOGRAM_MAX_LENGTH; the few longer reads are kept as a sorted array,
+so one corrupt length cannot blow up the histogram.
+
+count_at_or_above() counts values (e.g. mean q-scores) at or above each of a
+set of thresholds in one pass; NaN counts as below every threshold.
+
+Run this file directly to check every available backend against a plain Python
+reference (see check_backends()); with --build, the extension is built first.
+"""
+
+import os
+import numpy as np
+
+# Lengths below this get one histogram bin each (32 MiB of int64 counts at most)
+HISTOGRAM_MAX_LENGTH = 1 << 22
+
+# The extension is only imported once built (python stats_kernel.py --build);
+# it is never compiled on import
+try:
+    from _stats_kernel_cy import summarize_loop as _summarize_cy
+except ImportError:
+    _summarize_cy = None
+
+
+def _summarize_loop(lengths_asc, target, thresholds):
+    n_thresholds = thresholds.shape[0]
+    counts = np.zeros(n_thresholds, dtype=np.int64)
+    tail_bases = np.zeros(n_thresholds, dtype=np.int64)
+    shortest = thresholds.min() if n_thresholds else 0
+
+    # Walk from the longest read down
+    cumulative = 0
+    n50 = 0
+    found = False
+    for i in range(lengths_asc.shape[0] - 1, -1, -1):
+        x = lengths_asc[i]
+        cumulative += x
+        if not found and cumulative >= target:
+            n50 = x
+            found = True
+        # Lengths are sorted, so nothing below the shortest threshold contributes
+        if x < shortest:
+            if found:
+                break
+            continue
+        for k in range(n_thresholds):
+            if x >= thresholds[k]:
+                counts[k] += 1
+                tail_bases[k] += x
+    return n50, counts, tail_bases
+
+
+def _summarize_numpy(lengths_asc, target, thresholds):
+    n = len(lengths_asc)
+    cumulative = np.cumsum(lengths_asc, dtype=np.int64)
+    total = cumulative[-1]
+
+    # The N50 read is the shortest one whose suffix (it and every longer read) reaches
+    # target, i.e. the last index whose prefix sum before it is <= total - target
+    n50_index = min(np.searchsorted(cumulative, total - target, side='right'), n - 1)
+    n50 = lengths_asc[n50_index]
+
+    # Reads from index idx onwards are >= the threshold; their bases are total - cumulative[idx - 1]
+    idx = np.searchsorted(lengths_asc, thresholds)
+    counts = n - idx
+    tail_bases = total - np.where(idx > 0, cumulative[idx - 1], 0)
+    return n50, counts, tail_bases
+
+
+if _summarize_cy is not None:
+    # numba is only imported when there is no Cython kernel
+    _summarize_int32 = _summarize_cy
+    _summarize = _summarize_numpy
+else:
+    try:
+        from numba import njit
+        _summarize = njit(cache=True)(_summarize_loop)
+    except ImportError:
+        _summarize = _summarize_numpy
+    _summarize_int32 = _summarize
+
+
+def summarize(lengths_asc, target, thresholds):
+    """
+    Summarize a non-empty array of read lengths sorted in ascending order.
+
+    lengths_asc  : read lengths, shortest first (as left by ndarray.sort())
+    target       : bases the N50 read must reach (normally total_bases / 2)
+    thresholds   : array of length cut-offs, same dtype as lengths_asc
+
+    Returns (N50, counts, tail_bases) where counts[k] and tail_bases[k] are the
+    number of reads and bases in reads with length >= thresholds[k]. Contiguous
+    int32 arrays (what the scripts pass) take the compiled kernel; any other
+    integer dtype is summarized by numba or NumPy.
+    """
+    if (lengths_asc.dtype == np.int32 and thresholds.dtype == np.int32
+            and lengths_asc.flags.c_contiguous and thresholds.flags.c_contiguous):
+        kernel = _summarize_int32
+    else:
+        kernel = _summarize
+    n50, counts, tail_bases = kernel(lengths_asc, target, thresholds)
+    return int(n50), counts, tail_bases
+
+
+def length_histogram(lengths, hist=None):
+    """
+    Add non-negative read lengths to a length histogram and return the updated
+    histogram. A histogram is a (bins, overflow) pair: bins[L] is the number of
+    reads of exactly L bases for L below HISTOGRAM_MAX_LENGTH, growing up to the
+    longest such read, and overflow holds the lengths of the longer reads,
+    sorted. Lets aggregated modes stream blocks or files through without ever
+    holding every read length.
+    """
+    overflow = np.empty(0, dtype=np.int64)
+    if len(lengths) and lengths.max() >= HISTOGRAM_MAX_LENGTH:
+        longer = lengths >= HISTOGRAM_MAX_LENGTH
+        overflow = np.sort(lengths[longer]).astype(np.int64, copy=False)
+        lengths = lengths[~longer]
+    bins = np.bincount(lengths, minlength=1).astype(np.int64, copy=False)
+    return merge_histograms(hist, (bins, overflow))
+
+
+def merge_histograms(hist, other):
+    """
+    Add length histogram other into hist (which may be None), growing its bins
+    to the longer of the two. Returns the merged histogram; either input may be
+    reused.
+    """
+    if hist is None:
+        return other
+    bins, overflow = hist
+    other_bins, other_overflow = other
+    if len(other_bins) > len(bins):
+        bins, other_bins = other_bins, bins
+    bins[:len(other_bins)] += other_bins
+    if len(other_overflow):
+        overflow = np.sort(np.concatenate((overflow, other_overflow)))
+    return bins, overflow
+
+
+def summarize_histogram(hist, target, thresholds):
+    """
+    Same as summarize(), for a histogram built by length_histogram(). Because the
+    histogram has one bin per length, and keeps longer reads as they are, the
+    results are exact, not binned.
+    """
+    bins, overflow = hist
+    n_bins = len(bins)
+    read_cumulative = np.cumsum(bins)
+    base_cumulative = np.cumsum(bins * np.arange(n_bins, dtype=np.int64))
+    total_reads = read_cumulative[-1]
+    total_bases = base_cumulative[-1]
+
+    # Bases in the overflow reads, longest first, then shortest first
+    overflow_desc = np.cumsum(overflow[::-1])
+    overflow_asc = np.concatenate(([0], np.cumsum(overflow)))
+    overflow_bases = overflow_asc[-1]
+
+    if len(overflow) and overflow_bases >= target:
+        # The N50 read is among the overflow reads
+        n50 = overflow[::-1][np.searchsorted(overflow_desc, target)]
+    else:
+        # N50 is the longest length L for which reads of L bases or more, plus the
+        # overflow reads, hold >= target bases
+        n50 = min(np.searchsorted(base_cumulative, total_bases - (target - overflow_bases), side='right'),
+                  n_bins - 1)
+
+    idx = np.minimum(thresholds, n_bins)
+    counts = total_reads - np.where(idx > 0, read_cumulative[idx - 1], 0)
+    tail_bases = total_bases - np.where(idx > 0, base_cumulative[idx - 1], 0)
+    above = np.searchsorted(overflow, thresholds)
+    counts += len(overflow) - above
+    tail_bases += overflow_bases - overflow_asc[above]
+    return int(n50), counts, tail_bases
+
+
+def count_at_or_above(values, thresholds):
+    """
+    Return the number of values at or above each of thresholds (sorted ascending).
+    A single searchsorted pass bins every value by the highest threshold it
+    clears; a reverse cumsum over the bins then gives the "at or above" counts.
+    NaN values are put in the bottom bin, as a failed ">=" comparison would.
+    """
+    bins = np.searchsorted(thresholds, values, side='right')
+    # searchsorted sorts NaN after every threshold
+    bins[np.isnan(values)] = 0
+    counts = np.bincount(bins, minlength=len(thresholds) + 1)
+    return counts[::-1].cumsum()[::-1][1:]
+
+
+def _reference(lengths, target, thresholds):
+    # Plain descending walk, as the original per-script loops did it
+    lengths_desc = sorted(lengths.tolist(), reverse=True)
+    cumulative = 0
+    n50 = 0
+    for x in lengths_desc:
+        cumulative += x
+        if cumulative >= target:
+            n50 = x
+            break
+    counts = [sum(1 for x in lengths_desc if x >= t) for t in thresholds.tolist()]
+    tail_bases = [sum(x for x in lengths_desc if x >= t) for t in thresholds.tolist()]
+    return n50, counts, tail_bases
+
+
+def check_backends(n_arrays=300, seed=0):
+    """
+    Check that every available backend (Cython, numba, NumPy, summarize() on int64
+    input, and the histogram path) agrees with a plain Python reference on random
+    read-length arrays, including heavily tied ones and ones with reads past the
+    histogram bins, and that count_at_or_above() matches per-value ">=" comparisons
+    on q-scores with ties, NaN and inf. Raises AssertionError on the first
+    mismatch; returns the names of the backends checked.
+    """
+    backends = {'numpy': _summarize_numpy}
+    if _summarize_cy is not None:
+        backends['cython'] = _summarize_cy
+    try:
+        from numba import njit
+        backends['numba'] = njit(cache=True)(_summarize_loop)
+    except ImportError:
+        pass
+
+    threshold_sets = [np.array([], dtype=np.int32),
+                      np.array([20000, 40000, 60000, 80000, 100000], dtype=np.int32),
+                      np.array([100000, 200000, 300000, 400000, 500000, 1000000], dtype=np.int32)]
+    rng = np.random.default_rng(seed)
+    for i in range(n_arrays):
+        n = int(rng.integers(1, 5000))
+        if i % 4 == 3:
+            lengths = rng.integers(1, 50, n).astype(np.int32)
+        else:
+            lengths = np.exp(rng.normal(9.5, 1.3, n)).astype(np.int32) + 1
+        if i % 4 == 2:
+            # A few reads past the histogram bins, up to every read on odd rounds
+            k = n if i % 8 == 6 else min(n, int(rng.integers(1, 20)))
+            lengths[:k] = rng.integers(HISTOGRAM_MAX_LENGTH - 2, 2000000000, k)
+        lengths.sort()
+        thresholds = threshold_sets[i % len(threshold_sets)]
+        target = lengths.sum(dtype=np.int64) / 2.0
+
+        results = {name: kernel(lengths, target, thresholds) for name, kernel in backends.items()}
+        results['summarize(int64)'] = summarize(lengths.astype(np.int64), target, thresholds.astype(np.int64))
+        # Built from two shuffled halves, so merging is covered too
+        shuffled = rng.permutation(lengths)
+        hist = length_histogram(shuffled[n // 2:], length_histogram(shuffled[:n // 2]))
+        results['histogram'] = summarize_histogram(hist, target, thresholds)
+
+        expected = _reference(lengths, target, thresholds)
+        for name, (n50, counts, tail_bases) in results.items():
+            got = (int(n50), [int(c) for c in counts], [int(b) for b in tail_bases])
+            if got != expected:
+                raise AssertionError("%s differs from the reference on array %d: %s != %s"
+                                     % (name, i, got, expected))
+
+    qscore_thresholds = np.array([5, 10, 15, 20, 25], dtype=np.float32)
+    special = np.array([np.nan, np.inf, -np.inf, 0, 5, 10, 25], dtype=np.float32)
+    for i in range(n_arrays):
+        n = int(rng.integers(1, 2000))
+        qscores = rng.uniform(0, 30, n).astype(np.float32)
+        qscores[rng.integers(0, n, n // 10 + 1)] = rng.choice(special, n // 10 + 1)
+        got = [int(c) for c in count_at_or_above(qscores, qscore_thresholds)]
+        expected = [sum(1 for q in qscores.tolist() if q >= t) for t in qscore_thresholds.tolist()]
+        if got != expected:
+            raise AssertionError("count_at_or_above differs from the reference on array %d: %s != %s"
+                                 % (i, got, expected))
+    return sorted(results) + ['count_at_or_above']
+
+
+def build_extension():
+    """
+    Compile _stats_kernel_cy.pyx with -O3 into an extension module next to this
+    file, where the scripts import it from. Needs Cython, setuptools and a C
+    compiler; intermediate files go to a temporary directory. Returns the path
+    of the built module.
+    """
+    import tempfile
+    from setuptools import Extension
+    from setuptools.dist import Distribution
+    from Cython.Build import cythonize
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        ext = Extension("_stats_kernel_cy", [os.path.join(here, "_stats_kernel_cy.pyx")],
+                        extra_compile_args=["-O3"])
+        dist = Distribution({"ext_modules": cythonize([ext], build_dir=tmp, quiet=True)})
+        cmd = dist.get_command_obj("build_ext")
+        cmd.build_lib = here
+        cmd.build_temp = tmp
+        cmd.ensure_finalized()
+        cmd.run()
+        return cmd.get_ext_fullpath("_stats_kernel_cy")
+
+
+if __name__ == '__main__':
+    import argparse
+    import importlib
+
+    parser = argparse.ArgumentParser(description="Check the stats_kernel backends against a plain Python reference.")
+    parser.add_argument("--build", action="store_true",
+                        help="Build the Cython extension from _stats_kernel_cy.pyx first")
+    args = parser.parse_args()
+
+    if args.build:
+        print("Built %s" % build_extension())
+        importlib.invalidate_caches()
+        _summarize_cy = _summarize_int32 = importlib.import_module("_stats_kernel_cy").summarize_loop
+    print("stats_kernel backends agree with the reference: %s" % ", ".join(check_backends()))
@@ -0,0 +1,319 @@
+"""
+summary_io.py
+
+Reading helpers shared by the calculate_summary_stats_* scripts: finding
+sequencing_summary files under a directory, opening (and decompressing) them,
+and parsing them with arrow's CSV reader.
+
+Gzipped files are inflated, in order of preference, by a pigz subprocess, by
+isal in-process, by a gzip subprocess, or by Python's gzip module. All of them
+report a truncated or corrupt file, which is then dropped.
+"""
+
+import io
+import os
+import re
+import sys
+import gzip
+import subprocess
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+# ISA-L's igzip is a drop-in for gzip with SIMD inflate; use it when installed
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+LENGTH_COLUMN = "sequence_length_template"
+QSCORE_COLUMN = "mean_qscore_template"
+
+# Summary files are tab-delimited; rows with the wrong number of fields are skipped.
+READ_OPTIONS = pacsv.ReadOptions(block_size=8 << 20)
+PARSE_OPTIONS = pacsv.ParseOptions(delimiter='\t', invalid_row_handler=lambda row: 'skip')
+
+# Numeric columns are read as strings and cast per block with arrow. Values the
+# cast rejects (empty, "NA", a stray repeated header row, ...) drop only their own
+# row, as int()/float() failing did in the old line-by-line parsers; a row is kept
+# when its values match these patterns. Integer columns are read lengths, so a
+# negative value drops its row too.
+NUMBER_PATTERNS = {
+    pa.int32(): r"^\d{1,9}$",
+    pa.float32(): r"(?i)^[+-]?((\d+\.?\d*|\.\d+)(e[+-]?\d+)?|nan|inf|infinity)$",
+}
+
+# What a truncated, corrupt or malformed file raises while being read
+READ_ERRORS = (pa.ArrowException, OSError, EOFError)
+
+# Names picked up by the --dir walk, tested once per directory entry
+SUMMARY_FILE_RE = re.compile(r"^sequencing_summary|_summary\.txt\.gz$")
+
+
+def find_summary_files(root):
+    """
+    Walk root once with os.scandir and return the paths of all files whose name
+    starts with "sequencing_summary" or ends with "_summary.txt.gz", sorted.
+    Like a recursive glob, hidden entries are skipped, symlinked directories are
+    followed and unreadable directories ignored. Each directory is entered once
+    (by device and inode), so symlink cycles end the walk instead of looping.
+    """
+    stack = [root]
+    visited = set()
+    found = []
+    while stack:
+        d = stack.pop()
+        try:
+            st = os.stat(d)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            with os.scandir(d) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif SUMMARY_FILE_RE.search(entry.name):
+                        found.append(entry.path)
+        except OSError:
+            continue
+    return sorted(found)
+
+
+class _CheckedReader(io.RawIOBase):
+    """
+    Read-only stream over a decompressor whose result is checked once the stream
+    is drained: check() is called at EOF and raises OSError if the data was cut
+    short, so a truncated or corrupt .gz fails instead of passing for a short file.
+    Exceptions of the types in errors, raised by the decompressor on bad data, are
+    re-raised as OSError. close() always releases the decompressor.
+    """
+
+    def __init__(self, stream, check, release=None, errors=()):
+        self._stream = stream
+        self._check = check
+        self._release = release
+        self._errors = errors
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            n = self._stream.readinto(b)
+        except self._errors as e:
+            raise OSError(str(e)) from e
+        if not n and len(b):
+            self._check()
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+            if self._release is not None:
+                self._release()
+        super().close()
+
+
+def _pipe_reader(cmd, inFile):
+    """
+    Start cmd with inFile on stdin and wrap its stdout, raising at EOF if it exited
+    non-zero (pigz and gzip both do on truncated or corrupt input). Returns None
+    when cmd is not on the PATH.
+    """
+    with open(inFile, 'rb') as src:
+        try:
+            proc = subprocess.Popen(cmd, stdin=src, stdout=subprocess.PIPE, bufsize=1 << 20)
+        except FileNotFoundError:
+            return None
+
+    def check():
+        if proc.wait() != 0:
+            raise OSError("'%s' exited with status %d" % (" ".join(cmd), proc.returncode))
+    return io.BufferedReader(_CheckedReader(proc.stdout, check, proc.wait), 1 << 20)
+
+
+def available_cpus():
+    """
+    Number of CPUs this process may run on: its affinity mask where the platform
+    has one (Linux, so a Slurm or taskset allocation is respected), otherwise
+    the machine's CPU count.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def init_worker():
+    """
+    ProcessPoolExecutor initializer for directory mode. Files already run one per
+    core there, so each worker's arrow reader is kept to a single thread rather
+    than sizing its pool to the whole machine (workers x cores threads).
+    """
+    pa.set_cpu_count(1)
+
+
+def open_summary(inFile):
+    """
+    Open a summary file for binary reading, decompressing .gz files. A truncated
+    or corrupt file raises OSError (EOFError from the in-process decoders) from
+    read(), so callers drop the file rather than report partial data.
+    """
+    if not inFile.endswith('.gz'):
+        return open(inFile, 'rb', buffering=1 << 20)
+    f = _pipe_reader(['pigz', '-dc'], inFile)
+    if f is not None:
+        return f
+    # In-process isal inflates several times faster than piping through gzip -dc
+    if igzip is not None:
+        return igzip.open(inFile, 'rb')
+    f = _pipe_reader(['gzip', '-dc'], inFile)
+    if f is not None:
+        return f
+    return gzip.open(inFile, 'rb')
+
+
+def _convert_options(types):
+    return pacsv.ConvertOptions(include_columns=list(types),
+                                column_types={name: pa.string() for name in types})
+
+
+def _cast_block(data, numeric):
+    """
+    Cast the columns named in numeric ({column: arrow type}) of a whole block.
+    Returns None if any value does not parse or an integer column holds a
+    negative value.
+    """
+    try:
+        cast = {name: pc.cast(data.column(name), t) for name, t in numeric.items()}
+    except pa.ArrowInvalid:
+        return None
+    for name, t in numeric.items():
+        if pa.types.is_integer(t) and (pc.min(cast[name]).as_py() or 0) < 0:
+            return None
+    return cast
+
+
+def _convert(data, types):
+    """
+    Cast the string columns of an arrow table or batch named in types ({column:
+    arrow type}), dropping rows where any of them does not parse; pa.string()
+    columns are passed through as they are. Returns a dict of the columns. The
+    cast is tried on the whole block first; rows are only matched against
+    NUMBER_PATTERNS when it fails or turns up a negative length.
+    """
+    numeric = {name: t for name, t in types.items() if t != pa.string()}
+    cast = _cast_block(data, numeric)
+    if cast is None:
+        valid = None
+        for name, t in numeric.items():
+            ok = pc.match_substring_regex(data.column(name), NUMBER_PATTERNS[t])
+            valid = ok if valid is None else pc.and_(valid, ok)
+        data = data.filter(valid)
+        cast = {name: pc.cast(data.column(name), t) for name, t in numeric.items()}
+    return {name: cast[name] if name in cast else data.column(name) for name in types}
+
+
+def read_table(inFile, types):
+    """
+    Read the columns named in types ({column: arrow type}) from a summary file in
+    one multithreaded arrow pass; every other column is skipped. Returns a dict of
+    arrow columns. Raises on unreadable input: arrow errors, and OSError/EOFError
+    from a truncated or corrupt .gz.
+    """
+    f = open_summary(inFile)
+    try:
+        table = pacsv.read_csv(f, read_options=READ_OPTIONS,
+                               parse_options=PARSE_OPTIONS,
+                               convert_options=_convert_options(types))
+    finally:
+        f.close()
+    return _convert(table, types)
+
+
+def iter_blocks(inFile, types):
+    """
+    Same as read_table(), but streams the file through arrow's CSV reader and
+    yields a dict of arrow arrays per block, so only one block is held in memory.
+    Errors are raised from the iteration; whatever was already yielded for the
+    file has to be discarded by the caller.
+    """
+    f = open_summary(inFile)
+    try:
+        reader = pacsv.open_csv(f, read_options=READ_OPTIONS,
+                                parse_options=PARSE_OPTIONS,
+                                convert_options=_convert_options(types))
+        for batch in reader:
+            yield _convert(batch, types)
+    finally:
+        f.close()
+
+
+def read_header(inFile):
+    """
+    Return the header and the first data row of a summary file, split on whitespace.
+    Only the start of the file is decompressed.
+    """
+    with ((igzip or gzip).open(inFile, 'rt') if inFile.endswith('.gz') else open(inFile, 'r')) as f:
+        header = f.readline().strip().split()
+        first_row = f.readline().strip().split()
+    return header, first_row
+
+
+def _flowcell_id(pod5_name):
+    # e.g. "PBE83079_skip_15726cb4_58deb308_0.pod5" -> "PBE83079"
+    return pod5_name.split("_")[0]
+
+
+def read_summary(inFile, filename_columns, all_rows=False):
+    """
+    Read the read lengths of one sequencing_summary file with arrow, and the
+    flowcell ids: the first '_'-delimited field of the pod5 filename in the first
+    of filename_columns present in the header. Ids are taken from the first data
+    line only, or with all_rows=True from every row (a summary can span several
+    flowcells), at the cost of also parsing the filename column.
+    Returns a (read_lengths, flowcell_ids) tuple, with flowcell_ids a set (empty
+    when there is no filename column), or None if nothing could be read (the
+    reason goes to stderr).
+    """
+    try:
+        header, first_row = read_header(inFile)
+    except Exception as e:
+        sys.stderr.write("Error opening file %s: %s\n" % (inFile, str(e)))
+        return None
+
+    if LENGTH_COLUMN not in header:
+        sys.stderr.write("Error: '%s' not found in header of %s\n" % (LENGTH_COLUMN, inFile))
+        return None
+
+    flowcell_ids = set()
+    filename_column = next((c for c in filename_columns if c in header), None)
+    if filename_column is None:
+        sys.stderr.write("Warning: none of %s found in header of %s\n"
+                         % (", ".join("'%s'" % c for c in filename_columns), inFile))
+    elif not all_rows:
+        filename_index = header.index(filename_column)
+        if len(first_row) > filename_index:
+            flowcell_ids.add(_flowcell_id(first_row[filename_index]))
+
+    types = {LENGTH_COLUMN: pa.int32()}
+    if all_rows and filename_column is not None:
+        types[filename_column] = pa.string()
+
+    try:
+        columns = read_table(inFile, types)
+    except READ_ERRORS as e:
+        sys.stderr.write("Error reading %s: %s\n" % (inFile, str(e)))
+        return None
+
+    lengths = columns[LENGTH_COLUMN].to_numpy()
+    if len(lengths) == 0:
+        return None
+
+    # Only the distinct pod5 names (a few per flowcell) reach Python
+    if len(types) > 1:
+        flowcell_ids.update(_flowcell_id(name) for name in pc.unique(columns[filename_column]).to_pylist())
+    flowcell_ids.discard("")
+
+    return lengths, flowcell_ids